@@ -6,9 +6,56 @@
 # Dinkar Khandalekar (contact@dinkar.dev)
 # This code is in the public domain
 #-------------------------------------------------------------------------------
-from bisect import bisect_right
 from .die import DIE
-from ..common.utils import dwarf_assert
+from ..common.exceptions import ELFParseError
+from ..common.utils import dwarf_assert, struct_parse
+from ..construct import SizeofError
+
+
+# Forms of DW_AT_sibling whose value is relative to the start of the unit
+_SIBLING_REF_FORMS = frozenset((
+    'DW_FORM_ref1', 'DW_FORM_ref2', 'DW_FORM_ref4', 'DW_FORM_ref8',
+    'DW_FORM_ref', 'DW_FORM_ref_udata'))
+
+# Steps of DIE skip plans for LEB128-encoded and null-terminated string values.
+# See TypeUnit._get_DIE_skip_plan
+_SKIP_LEB128 = object()
+_SKIP_CSTRING = object()
+
+
+def _get_stream_buffer(stream, offset, size):
+    """ Returns a memoryview of size bytes of the given stream, starting at
+        offset. For in-memory streams, the contents are not copied.
+    """
+    if hasattr(stream, 'getbuffer'):
+        with stream.getbuffer() as whole:
+            return whole[offset:offset + size]
+    stream.seek(offset)
+    return memoryview(stream.read(size))
+
+
+def _read_uleb128(buf, offset):
+    """ Decodes the ULEB128 value at the given offset in buf. Returns the
+        value and the offset past it.
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def _skip_leb128(buf, offset):
+    """ Returns the offset past the LEB128 value at the given offset in buf.
+        Works for both signed and unsigned values.
+    """
+    while buf[offset] & 0x80:
+        offset += 1
+    return offset + 1
 
 
 class TypeUnit:
@@ -56,32 +103,31 @@ class TypeUnit:
         self.tu_offset = tu_offset
         self.tu_die_offset = tu_die_offset
 
+        # DIEs expect their unit to have cu_offset and cu_die_offset
+        # attributes, so provide them with the TU's offsets.
+        self.cu_offset = tu_offset
+        self.cu_die_offset = tu_die_offset
+
+        # The header is fixed, so the header fields used internally are
+        # read once
+        self._size = header['unit_length'] + structs.initial_length_field_size()
+        self._debug_abbrev_offset = header['debug_abbrev_offset']
+
+        # The stream is the same for all DIEs in this TU
+        self._stream = dwarfinfo.debug_types_sec.stream
+
         # The abbreviation table for this TU. Filled lazily when DIEs are
         # requested.
         self._abbrev_table = None
 
-        # A list of DIEs belonging to this TU.
-        # This list is lazily constructed as DIEs are iterated over.
-        self._dielist = []
-        # A list of file offsets, corresponding (by index) to the DIEs
-        # in `self._dielist`. This list exists separately from
-        # `self._dielist` to make it binary searchable, enabling the
-        # DIE population strategy used in `iter_DIE_children`.
-        # Like `self._dielist`, this list is lazily constructed
-        # as DIEs are iterated over.
-        self._diemap = []
-
-    @property
-    def cu_offset(self):
-        """Simulates the cu_offset attribute required by the DIE by returning the tu_offset instead
-        """
-        return self.tu_offset
-
-    @property
-    def cu_die_offset(self):
-        """Simulates the cu_die_offset attribute required by the DIE by returning the tu_offset instead
-        """
-        return self.tu_die_offset
+        # A dict mapping stream offsets to the DIEs belonging to this TU.
+        # DIEs are only ever looked up by their exact offset, so there's no
+        # need to keep them sorted. This dict is lazily populated as DIEs
+        # are iterated over.
+        self._die_by_offset = {}
+        # The top DIE of this TU, kept separately for fast access. Filled
+        # lazily by get_top_DIE.
+        self._top_die = None
 
     def dwarf_format(self):
         """ Get the DWARF format (32 or 64) for this TU
@@ -93,25 +139,19 @@ class TypeUnit:
         """
         if self._abbrev_table is None:
             self._abbrev_table = self.dwarfinfo.get_abbrev_table(
-                self['debug_abbrev_offset'])
+                self._debug_abbrev_offset)
         return self._abbrev_table
 
     def get_top_DIE(self):
         """ Get the top DIE (which is DW_TAG_type_unit entry) of this TU
         """
+        if self._top_die is not None:
+            return self._top_die
 
-        # Note that a top DIE always has minimal offset and is therefore
-        # at the beginning of our lists, so no bisect is required.
-        if self._diemap:
-            return self._dielist[0]
+        top = DIE(self, self._stream, self.tu_die_offset)
 
-        top = DIE(
-                cu=self,
-                stream=self.dwarfinfo.debug_types_sec.stream,
-                offset=self.tu_die_offset)
-
-        self._dielist.insert(0, top)
-        self._diemap.insert(0, self.tu_die_offset)
+        self._top_die = top
+        self._die_by_offset[self.tu_die_offset] = top
 
         top._translate_indirect_attributes()  # Can't translate indirect attributes until the top DIE has been parsed to the end
 
@@ -121,17 +161,57 @@ class TypeUnit:
         """ Returns whether the top DIE in this TU has already been parsed and cached.
             No parsing on demand!
         """
-        return bool(self._diemap)
+        return self._top_die is not None
 
     @property
     def size(self):
-        return self['unit_length'] + self.structs.initial_length_field_size()
+        return self._size
 
     def iter_DIEs(self):
         """ Iterate over all the DIEs in the TU, in order of their appearance.
             Note that null DIEs will also be returned.
         """
-        return self._iter_DIE_subtree(self.get_top_DIE())
+        top = self.get_top_DIE()
+        if self.dwarfinfo.supplementary_dwarfinfo:
+            # Imported units are replaced by the DIEs they refer to, which
+            # live in another unit, so the tree has to be walked.
+            return self._iter_DIE_subtree(top)
+        return self._iter_DIEs_sequential(top)
+
+    def iter_DIEs_uncached(self):
+        """ Iterate over all the DIEs in the TU, in order of their appearance,
+            without caching them in the TU. Note that null DIEs will also be
+            returned.
+
+            Only the top DIE and the ancestors of the current DIE are kept,
+            so iterating a huge TU this way doesn't take memory proportional
+            to its size. The DIEs yielded are not known to the TU:
+            get_DIE_from_refaddr and friends will parse fresh copies of them,
+            and their parents and null DIE terminators aren't recorded.
+        """
+        return self._iter_DIEs_sequential(self.get_top_DIE(), cached=False)
+
+    def iter_DIE_offsets(self):
+        """ Iterate over the offsets of all the DIEs in the TU, in order of
+            their appearance. Note that the offsets of null DIEs will also be
+            returned.
+
+            The DIEs are not parsed: only their abbreviation codes are read,
+            and their attribute values are skipped. Use get_DIE_from_refaddr
+            to obtain the DIE at a given offset.
+        """
+        for offset, _ in self._iter_DIE_offsets_and_tags():
+            yield offset
+
+    def iter_DIE_offsets_by_tag(self, tag):
+        """ Iterate over the offsets of the DIEs in the TU with the given tag
+            (e.g. 'DW_TAG_structure_type'), in order of their appearance.
+
+            Like iter_DIE_offsets, this doesn't parse the DIEs.
+        """
+        for offset, die_tag in self._iter_DIE_offsets_and_tags():
+            if die_tag == tag:
+                yield offset
 
     def iter_DIE_children(self, die):
         """ Given a DIE, yields either its children, without null DIE list
@@ -159,16 +239,17 @@ class TypeUnit:
 
             if not child.has_children:
                 cur_offset += child.size
-            elif "DW_AT_sibling" in child.attributes:
-                sibling = child.attributes["DW_AT_sibling"]
-                if sibling.form in ('DW_FORM_ref1', 'DW_FORM_ref2',
-                                    'DW_FORM_ref4', 'DW_FORM_ref8',
-                                    'DW_FORM_ref', 'DW_FORM_ref_udata'):
+                continue
+
+            sibling = child.attributes.get("DW_AT_sibling")
+            if sibling is not None:
+                form = sibling.form
+                if form in _SIBLING_REF_FORMS:
                     cur_offset = sibling.value + self.tu_offset
-                elif sibling.form == 'DW_FORM_ref_addr':
+                elif form == 'DW_FORM_ref_addr':
                     cur_offset = sibling.value
                 else:
-                    raise NotImplementedError('sibling in form %s' % sibling.form)
+                    raise NotImplementedError('sibling in form %s' % form)
             else:
                 # If no DW_AT_sibling attribute is provided by the producer
                 # then the whole child subtree must be parsed to find its next
@@ -222,6 +303,156 @@ class TypeUnit:
                 yield from die.cu._iter_DIE_subtree(c)
             yield die._terminator
 
+    def _iter_DIEs_sequential(self, top, cached=True):
+        """ Given the top DIE, yields all the DIEs of this TU (including null
+            DIEs) by parsing them one after another from the stream, rather
+            than walking the tree. DIEs are laid out in the section in the
+            same order in which the tree walk produces them.
+
+            If cached is True, the DIEs are looked up in and added to the
+            cache, and parents and null DIE terminators are recorded along
+            the way, just like iter_DIE_children does. Otherwise, fresh DIEs
+            are parsed and left alone.
+        """
+        yield top
+        if not top.has_children:
+            return
+
+        # The chain of DIEs whose children are currently being parsed
+        parents = [top]
+        cur_offset = top.offset + top.size
+        end_offset = self.cu_offset + self.size
+
+        while parents and cur_offset < end_offset:
+            if cached:
+                die = self._get_cached_DIE(cur_offset)
+                die.set_parent(parents[-1])
+            else:
+                die = DIE(self, self._stream, cur_offset)
+
+            if die.is_null():
+                if cached:
+                    parents[-1]._terminator = die
+                parents.pop()
+            elif die.has_children:
+                parents.append(die)
+
+            yield die
+            cur_offset += die.size
+
+    def _iter_DIE_offsets_and_tags(self):
+        """ Yields an (offset, tag) tuple for all the DIEs in the TU, in order
+            of their appearance, without parsing them. The tag of null DIEs is
+            None.
+        """
+        top = self.get_top_DIE()
+        yield top.offset, top.tag
+        if not top.has_children:
+            return
+
+        stream = self._stream
+        abbrev_table = self.get_abbrev_table()
+        # (tag, has_children, skip plan) tuples, by abbreviation code
+        abbrevs = {}
+
+        # Number of DIEs whose children are currently being skipped
+        depth = 1
+
+        # Abbreviation codes and the most common variable-sized values are
+        # read straight from the contents of the TU rather than through the
+        # stream. Offsets below are relative to the start of the TU, which
+        # is also the start of the buffer. Note that while the buffer is
+        # held, an in-memory stream can't be resized.
+        base = self.tu_offset
+        cur_offset = top.offset + top.size - base
+        end_offset = self.size
+        buf = _get_stream_buffer(stream, base, end_offset)
+        try:
+            while depth and cur_offset < end_offset:
+                die_offset = cur_offset
+                abbrev_code, cur_offset = _read_uleb128(buf, die_offset)
+                if abbrev_code == 0:
+                    depth -= 1
+                    yield base + die_offset, None
+                    continue
+
+                abbrev = abbrevs.get(abbrev_code)
+                if abbrev is None:
+                    abbrev_decl = abbrev_table.get_abbrev(abbrev_code)
+                    abbrev = (abbrev_decl['tag'], abbrev_decl.has_children(),
+                              self._get_DIE_skip_plan(abbrev_decl))
+                    abbrevs[abbrev_code] = abbrev
+                tag, has_children, steps = abbrev
+
+                yield base + die_offset, tag
+
+                if has_children:
+                    depth += 1
+
+                if steps is None:
+                    # The attributes can't be skipped without parsing the DIE
+                    cur_offset = die_offset + DIE(
+                        self, stream, base + die_offset).size
+                    continue
+
+                for step in steps:
+                    if isinstance(step, int):
+                        cur_offset += step
+                    elif step is _SKIP_LEB128:
+                        cur_offset = _skip_leb128(buf, cur_offset)
+                    elif step is _SKIP_CSTRING:
+                        while buf[cur_offset]:
+                            cur_offset += 1
+                        cur_offset += 1
+                    else:
+                        struct_parse(step, stream, base + cur_offset)
+                        cur_offset = stream.tell() - base
+        except IndexError:
+            raise ELFParseError(
+                'DIE at offset %s runs past the end of its TU' % (
+                    base + die_offset))
+        finally:
+            buf.release()
+
+    def _get_DIE_skip_plan(self, abbrev_decl):
+        """ Given an abbreviation declaration, returns the steps to skip the
+            attribute values of a DIE using it. Each step is either a number
+            of bytes to skip, _SKIP_LEB128 or _SKIP_CSTRING for values of these
+            encodings, or a struct to parse from the stream for other
+            variable-sized values. Consecutive fixed-size values are merged
+            into a single step.
+
+            Returns None if the DIE has to be fully parsed to be skipped.
+        """
+        structs = self.structs
+        steps = []
+        for spec in abbrev_decl['attr_spec']:
+            form = spec.form
+            if form == 'DW_FORM_implicit_const':
+                # The value is stored in the abbreviation declaration
+                continue
+            if form == 'DW_FORM_indirect' or form not in structs.Dwarf_dw_form:
+                return None
+
+            form_struct = structs.Dwarf_dw_form[form]
+            if (form_struct is structs.the_Dwarf_uleb128 or
+                    form_struct is structs.the_Dwarf_sleb128):
+                steps.append(_SKIP_LEB128)
+                continue
+            if form == 'DW_FORM_string':
+                steps.append(_SKIP_CSTRING)
+                continue
+            try:
+                size = form_struct.sizeof()
+            except SizeofError:
+                steps.append(form_struct)
+                continue
+            if steps and isinstance(steps[-1], int):
+                steps[-1] += size
+            else:
+                steps.append(size)
+        return tuple(steps)
+
     def _get_cached_DIE(self, offset):
         """ Given a DIE offset, look it up in the cache.  If not present,
             parse the DIE and insert it into the cache.
@@ -229,30 +460,19 @@ class TypeUnit:
             offset:
                 The offset of the DIE in the debug_types section to retrieve.
 
-            The stream reference is copied from the top DIE.  The top die will
-            also be parsed and cached if needed.
+            The top DIE is parsed via get_top_DIE, so that its indirect
+            attributes get translated.
 
             See also get_DIE_from_refaddr(self, refaddr).
         """
-        # The top die must be in the cache if any DIE is in the cache.
-        # The stream is the same for all DIEs in this TU, so populate
-        # the top DIE and obtain a reference to its stream.
-        top_die_stream = self.get_top_DIE().stream
-
         # `offset` is the offset in the stream of the DIE we want to return.
-        # The map is maintined as a parallel array to the list.  We call
-        # bisect each time to ensure new DIEs are inserted in the correct
-        # order within both `self._dielist` and `self._diemap`.
-        i = bisect_right(self._diemap, offset)
-
-        # Note that `self._diemap` cannot be empty because a the top DIE
-        # was inserted by the call to .get_top_DIE().  Also it has the minimal
-        # offset, so the bisect_right insert point will always be at least 1.
-        if offset == self._diemap[i - 1]:
-            die = self._dielist[i - 1]
-        else:
-            die = DIE(cu=self, stream=top_die_stream, offset=offset)
-            self._dielist.insert(i, die)
-            self._diemap.insert(i, offset)
+        # DIEs are only looked up by exact offset, so a plain dict lookup
+        # suffices.
+        die = self._die_by_offset.get(offset)
+        if die is None:
+            if offset == self.tu_die_offset:
+                return self.get_top_DIE()
+            die = DIE(self, self._stream, offset)
+            self._die_by_offset[offset] = die
 
         return die
@@ -7,6 +7,7 @@
 # This code is in the public domain
 #-------------------------------------------------------------------------------
 from collections import namedtuple
+import struct
 
 from ..common.exceptions import ELFRelocationError
 from ..common.utils import elf_assert, struct_parse
@@ -92,6 +93,27 @@ class RelocationTable:
         for i in range(self.num_relocations()):
             yield self.get_relocation(i)
 
+    def iter_relocation_offsets(self):
+        """ Yield the r_offset field of all the relocations in the section.
+
+            The whole table is read at once and only the offsets are unpacked,
+            which is much faster than creating Relocation objects when the
+            offsets are all that's needed.
+        """
+        # r_offset is the first field of both REL and RELA entries, and is
+        # laid out the same way on all architectures.
+        fmt = '%s%s%dx' % (
+            '<' if self._elffile.little_endian else '>',
+            'I' if self._elffile.elfclass == 32 else 'Q',
+            self.entry_size - self._elffile.elfclass // 8)
+        size = self.num_relocations() * self.entry_size
+        self._stream.seek(self._offset)
+        data = self._stream.read(size)
+        elf_assert(len(data) == size,
+            'Relocation table at offset %s is truncated' % self._offset)
+        for (r_offset,) in struct.iter_unpack(fmt, data):
+            yield r_offset
+
 
 class RelocationSection(Section, RelocationTable):
     """ ELF relocation section. Serves as a collection of Relocation entries.
@@ -0,0 +1,224 @@
+#------------------------------------------------------------------------------
+# elftools tests
+#
+# This code is in the public domain
+#------------------------------------------------------------------------------
+import unittest
+import io
+import os
+import tempfile
+import weakref
+
+from collections import namedtuple
+
+from elftools.common.exceptions import ELFParseError
+from elftools.dwarf.abbrevtable import AbbrevDecl
+from elftools.dwarf.typeunit import _SKIP_LEB128, _SKIP_CSTRING
+from elftools.elf.elffile import ELFFile
+
+
+class TestTypeUnitIterDIEs(unittest.TestCase):
+    """ The DIEs of a type unit are iterated by parsing the section
+        sequentially. Check that this yields the same DIEs, parents and
+        null DIE terminators as walking the DIE tree.
+    """
+    def _get_dwarfinfo(self, f):
+        elffile = ELFFile(f)
+        self.assertTrue(elffile.has_dwarf_info())
+        return elffile.get_dwarf_info()
+
+    def _iter_TUs(self, path=os.path.join('test', 'testfiles_for_unittests',
+                                          'dwarf_debug_types.elf')):
+        """ Yields the TUs of the given test file
+        """
+        with open(path, 'rb') as f:
+            yield from self._get_dwarfinfo(f).iter_TUs()
+
+    def _walk(self, die):
+        yield die
+        if die.has_children:
+            for child in die.iter_children():
+                yield from self._walk(child)
+            yield die._terminator
+
+    def test_iter_DIEs_matches_tree_walk(self):
+        for tu in self._iter_TUs():
+            dies = list(tu.iter_DIEs())
+            self.assertGreater(len(dies), 1)
+
+            # Walk the tree of the same TU parsed afresh
+            fresh_tu = tu.dwarfinfo._parse_TU_at_offset(tu.tu_offset)
+            walked = list(self._walk(fresh_tu.get_top_DIE()))
+
+            self.assertEqual([d.offset for d in dies],
+                             [d.offset for d in walked])
+            self.assertEqual([d.tag for d in dies],
+                             [d.tag for d in walked])
+            for die, wdie in zip(dies, walked):
+                self.assertEqual(
+                    die._parent.offset if die._parent else None,
+                    wdie._parent.offset if wdie._parent else None)
+                if die.has_children:
+                    self.assertEqual(die._terminator.offset,
+                                     wdie._terminator.offset)
+
+    def test_iter_DIEs_with_supplementary_dwarfinfo(self):
+        # With a supplementary DWARF, the DIE tree is walked instead, which
+        # yields the same DIEs when there are no imported units.
+        with open(os.path.join('test',
+                               'testfiles_for_unittests', 'test_gnudebugaltlink.common'),
+                  'rb') as f:
+            supplementary_dwarfinfo = self._get_dwarfinfo(f)
+            for tu in self._iter_TUs():
+                dwarfinfo = tu.dwarfinfo
+                expected = [(d.offset, d.tag) for d in tu.iter_DIEs()]
+                # All the TUs share the DWARFInfo, so don't leave it changed
+                dwarfinfo.supplementary_dwarfinfo = supplementary_dwarfinfo
+                try:
+                    fresh_tu = dwarfinfo._parse_TU_at_offset(tu.tu_offset)
+                    self.assertEqual(
+                        [(d.offset, d.tag) for d in fresh_tu.iter_DIEs()],
+                        expected)
+                finally:
+                    dwarfinfo.supplementary_dwarfinfo = None
+
+    def test_iter_DIEs_follows_imported_units(self):
+        with open(os.path.join('test',
+                               'testfiles_for_unittests', 'test_gnudebugaltlink.common'),
+                  'rb') as f:
+            supplementary_dwarfinfo = self._get_dwarfinfo(f)
+            partial_unit = next(supplementary_dwarfinfo.iter_CUs())
+            imported = [d.offset for d in partial_unit.iter_DIEs()]
+
+            for tu in self._iter_TUs():
+                offsets = [d.offset for d in tu.iter_DIEs()]
+
+                # Turn the first child of the top DIE into an import of the
+                # partial unit. All the TUs share the DWARFInfo, so don't
+                # leave it changed.
+                dwarfinfo = tu.dwarfinfo
+                dwarfinfo.supplementary_dwarfinfo = supplementary_dwarfinfo
+                try:
+                    tu = dwarfinfo._parse_TU_at_offset(tu.tu_offset)
+                    child = next(tu.get_top_DIE().iter_children())
+                    self.assertFalse(child.has_children)
+                    child.tag = 'DW_TAG_imported_unit'
+                    child.get_DIE_from_attribute = (
+                        lambda name: partial_unit.get_top_DIE())
+
+                    i = offsets.index(child.offset)
+                    self.assertEqual([d.offset for d in tu.iter_DIEs()],
+                                     offsets[:i] + imported + offsets[i + 1:])
+                finally:
+                    dwarfinfo.supplementary_dwarfinfo = None
+
+    def test_iter_DIEs_uncached(self):
+        for tu in self._iter_TUs():
+            dies = list(tu.iter_DIEs_uncached())
+            # Only the top DIE gets cached
+            self.assertEqual(list(tu._die_by_offset), [tu.tu_die_offset])
+            self.assertTrue(all(d._parent is None for d in dies))
+            self.assertEqual([(d.offset, d.tag, d.size) for d in dies],
+                             [(d.offset, d.tag, d.size) for d in tu.iter_DIEs()])
+
+    def test_iter_DIE_offsets(self):
+        # The TI CCS binaries have many TUs, with DW_FORM_exprloc values that
+        # are skipped by parsing them
+        for path in (
+                os.path.join('test', 'testfiles_for_unittests',
+                             'dwarf_debug_types.elf'),
+                os.path.join('test', 'testfiles_for_dwarfdump',
+                             'dwarf_v4_ticcs.elf'),
+                os.path.join('test', 'testfiles_for_dwarfdump',
+                             'dwarf_v3_ticcs.elf')):
+            for tu in self._iter_TUs(path):
+                offsets = list(tu.iter_DIE_offsets())
+                self.assertEqual(offsets, [d.offset for d in tu.iter_DIEs()])
+
+    def test_iter_DIE_offsets_parsing_DIEs(self):
+        # DIEs whose attributes can't be skipped (e.g. with DW_FORM_indirect)
+        # are fully parsed instead
+        for tu in self._iter_TUs():
+            tu._get_DIE_skip_plan = lambda abbrev_decl: None
+            offsets = list(tu.iter_DIE_offsets())
+            self.assertEqual(offsets, [d.offset for d in tu.iter_DIEs()])
+
+    def test_DIE_skip_plan(self):
+        AttrSpec = namedtuple('AttrSpec', 'name form value')
+        def make_abbrev_decl(*forms):
+            return AbbrevDecl(1, {
+                'tag': 'DW_TAG_variable',
+                'children_flag': 'DW_CHILDREN_no',
+                'attr_spec': [AttrSpec('DW_AT_name', form, 0)
+                              for form in forms]})
+
+        for tu in self._iter_TUs():
+            # In this TU, offsets are 4 bytes and addresses 4 bytes
+            plan = tu._get_DIE_skip_plan(make_abbrev_decl(
+                'DW_FORM_data1', 'DW_FORM_implicit_const', 'DW_FORM_strp',
+                'DW_FORM_udata', 'DW_FORM_string', 'DW_FORM_flag_present',
+                'DW_FORM_exprloc', 'DW_FORM_data2'))
+            self.assertEqual(plan[:4], (5, _SKIP_LEB128, _SKIP_CSTRING, 0))
+            self.assertIs(plan[4], tu.structs.Dwarf_dw_form['DW_FORM_exprloc'])
+            self.assertEqual(plan[5:], (2,))
+
+            self.assertIsNone(tu._get_DIE_skip_plan(make_abbrev_decl(
+                'DW_FORM_data1', 'DW_FORM_indirect')))
+
+    def test_iter_DIE_offsets_truncated(self):
+        with open(os.path.join('test',
+                               'testfiles_for_unittests', 'dwarf_debug_types.elf'),
+                  'rb') as f:
+            dwarfinfo = self._get_dwarfinfo(f)
+            tu = next(dwarfinfo.iter_TUs())
+            top = tu.get_top_DIE()
+            # Cut the section in the middle of the DIEs following the top one
+            data = tu._stream.getvalue()[:top.offset + top.size + 1]
+            dwarfinfo.debug_types_sec = dwarfinfo.debug_types_sec._replace(
+                stream=io.BytesIO(data))
+            truncated_tu = dwarfinfo._parse_TU_at_offset(tu.tu_offset)
+            with self.assertRaises(ELFParseError):
+                list(truncated_tu.iter_DIE_offsets())
+
+    def test_iter_DIE_offsets_not_at_section_start(self):
+        # Move the TUs away from the start of the section, in an in-memory
+        # stream and in a stream without getbuffer(), which is read one TU at
+        # a time.
+        padding = 16
+        for make_stream in (io.BytesIO, tempfile.TemporaryFile):
+            for tu in self._iter_TUs():
+                expected = [d.offset + padding for d in tu.iter_DIEs()]
+
+                # All the TUs share the DWARFInfo, and iter_TUs() still reads
+                # the section, so put it back when done
+                dwarfinfo = tu.dwarfinfo
+                debug_types_sec = dwarfinfo.debug_types_sec
+                with make_stream() as stream:
+                    stream.write(b'\0' * padding + tu._stream.getvalue())
+                    dwarfinfo.debug_types_sec = debug_types_sec._replace(
+                        stream=stream)
+                    try:
+                        moved_tu = dwarfinfo._parse_TU_at_offset(
+                            tu.tu_offset + padding)
+                        self.assertEqual(list(moved_tu.iter_DIE_offsets()),
+                                         expected)
+                    finally:
+                        dwarfinfo.debug_types_sec = debug_types_sec
+
+    def test_iter_DIE_offsets_by_tag(self):
+        for tu in self._iter_TUs():
+            for tag in ('DW_TAG_type_unit', 'DW_TAG_enumerator'):
+                self.assertEqual(
+                    list(tu.iter_DIE_offsets_by_tag(tag)),
+                    [d.offset for d in tu.iter_DIEs() if d.tag == tag])
+
+    def test_set_attribute(self):
+        # Client code (e.g. scripts/dwarfdump.py) caches its own data on units
+        for tu in self._iter_TUs():
+            tu._lineprogram = None
+            self.assertIsNone(tu._lineprogram)
+            self.assertIs(weakref.ref(tu)(), tu)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,7 @@ import unittest
 
 from elftools.elf.elffile import ELFFile
 from elftools.elf.dynamic import DynamicSegment, DynamicSection
+from elftools.elf.relocation import RelocationSection
 
 
 class TestRelocation(unittest.TestCase):
@@ -42,5 +43,20 @@ class TestRelocation(unittest.TestCase):
                     relos = sect.get_relocation_tables()
                     self.assertEqual(set(relos), {'JMPREL', 'REL'})
 
+    def test_iter_relocation_offsets(self):
+        """Verify that the bulk offsets match those of Relocation objects"""
+
+        test_dir = os.path.join('test', 'testfiles_for_unittests')
+        for filename in ('sample_exe64.elf', 'exe_solaris32_cc.elf',
+                         'aarch64_be_gnu_hash.so.elf', 'simple_gcc.elf.mips'):
+            with open(os.path.join(test_dir, filename), 'rb') as f:
+                elff = ELFFile(f)
+
+                for sect in elff.iter_sections():
+                    if isinstance(sect, RelocationSection):
+                        self.assertEqual(
+                            list(sect.iter_relocation_offsets()),
+                            [r['r_offset'] for r in sect.iter_relocations()])
+
 if __name__ == '__main__':
     unittest.main()